@@ -8,6 +8,10 @@ import sqlite3
 import time
 import logging
 import os
+import sys
+import threading
+import traceback
+from collections import deque
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 from bs4 import BeautifulSoup
@@ -33,10 +37,33 @@ load_dotenv()
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 print(TOKEN)
-GUILD_ID = int(os.getenv("GUID"))  
+# GUID/VCID/ACID seed the config of the original server; other servers are configured via commands
+GUILD_ID = int(os.getenv("GUID")) if os.getenv("GUID") else None
 print(GUILD_ID)
-VERIFY_CHANNEL_ID = int(os.getenv("VCID")) 
-ANNOUNCEMENT_CHANNEL_ID = int(os.getenv("ACID")) 
+VERIFY_CHANNEL_ID = int(os.getenv("VCID")) if os.getenv("VCID") else None
+ANNOUNCEMENT_CHANNEL_ID = int(os.getenv("ACID")) if os.getenv("ACID") else None
+SHARDED = os.getenv("SHARDED", "0").lower() in ("1", "true", "yes")
+CF_BATCH_SIZE = 300  # handles per user.info request
+CF_CALL_DELAY = 2  # seconds between API calls, Codeforces allows one call every 2 seconds
+CF_MAX_ATTEMPTS = 20  # user.info calls per batch before giving up on it for this cycle
+DIAGNOSTICS = os.getenv("DIAGNOSTICS", "0").lower() in ("1", "true", "yes")
+
+def get_positive_int_env(name, default):
+    """Reads a positive integer from env, falling back to the default on bad values."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        parsed = 0
+    if parsed <= 0:
+        logger.warning(f"Invalid {name}={value!r}, using {default}.")
+        return default
+    return parsed
+
+SLOW_CALLBACK_MS = get_positive_int_env("SLOW_CALLBACK_MS", 250)
+DIAGNOSTICS_REPORT_MINUTES = get_positive_int_env("DIAGNOSTICS_REPORT_MINUTES", 15)
 
 ROLE_MAP = {
     "newbie": "Newbie",
@@ -51,7 +78,10 @@ ROLE_MAP = {
     "legendary grandmaster": "Legendary Grandmaster"
 }
 
-bot = commands.Bot(command_prefix="!", intents=discord.Intents.all())
+if SHARDED:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=discord.Intents.all())
+else:
+    bot = commands.Bot(command_prefix="!", intents=discord.Intents.all())
 
 db = sqlite3.connect("/app/data/codeforces_users.db") # for docker container
 # db = sqlite3.connect("./data/codeforces_users.db") # for local testing
@@ -64,6 +94,15 @@ cursor.execute('''CREATE TABLE IF NOT EXISTS verified_users (
     rank TEXT,
     verified BOOLEAN DEFAULT 0
 )''')
+cursor.execute('''CREATE TABLE IF NOT EXISTS guild_config (
+    guild_id INTEGER PRIMARY KEY,
+    verify_channel_id INTEGER,
+    announcement_channel_id INTEGER,
+    role_map TEXT
+)''')
+if GUILD_ID:
+    cursor.execute("INSERT OR IGNORE INTO guild_config (guild_id, verify_channel_id, announcement_channel_id) VALUES (?, ?, ?)",
+                   (GUILD_ID, VERIFY_CHANNEL_ID, ANNOUNCEMENT_CHANNEL_ID))
 db.commit()
 
 # Database setup
@@ -81,6 +120,36 @@ cconn.commit()
 
 logger.info("Database initialized and table verified_users ensured.")
 
+guild_configs = {}  # guild_id -> config, cached so on_message doesn't hit the database
+
+def get_guild_config(guild_id):
+    """Returns the channel and role-map config for a guild, falling back to defaults."""
+    if guild_id in guild_configs:
+        return guild_configs[guild_id]
+
+    cursor.execute("SELECT verify_channel_id, announcement_channel_id, role_map FROM guild_config WHERE guild_id = ?", (guild_id,))
+    result = cursor.fetchone()
+    config = {
+        "verify_channel_id": result[0] if result else None,
+        "announcement_channel_id": result[1] if result else None,
+        "role_map": json.loads(result[2]) if result and result[2] else dict(ROLE_MAP)
+    }
+    guild_configs[guild_id] = config
+    return config
+
+def set_guild_config(guild_id, **fields):
+    """Updates the given config columns for a guild and drops the cached copy."""
+    for column, value in fields.items():
+        cursor.execute(f'''INSERT INTO guild_config (guild_id, {column}) VALUES (?, ?)
+                          ON CONFLICT(guild_id) DO UPDATE SET {column} = excluded.{column}''',
+                       (guild_id, value))
+    db.commit()
+    guild_configs.pop(guild_id, None)
+
+def is_verify_channel(channel):
+    guild = getattr(channel, "guild", None)
+    return guild is not None and channel.id == get_guild_config(guild.id)["verify_channel_id"]
+
 # Function to scrape CodeChef for verification using Selenium
 async def check_codechef_submission(username):
     url = f"https://www.codechef.com/users/{username}"
@@ -156,7 +225,7 @@ async def check_codechef_submission(username):
 async def verifycc(ctx, codechef_username: str):
     """Verify a CodeChef user by checking for a compilation error every 30 seconds for 5 minutes."""
     user = ctx.author
-    if ctx.channel.id != VERIFY_CHANNEL_ID:
+    if not is_verify_channel(ctx.channel):
         return
     await user.send(f"Hello {user.mention}, please submit a compilation error on CodeChef. I'll check every 30 seconds for the next 5 minutes. Username: {codechef_username}")
 
@@ -204,12 +273,12 @@ async def update_user_role_cc(member, rating):
 @tasks.loop(hours=6)
 async def update_roles_task():
     await bot.wait_until_ready()
-    guild = bot.guilds[0]  # Assuming bot is in one server
     ccursor.execute("SELECT discord_id, rating FROM verified_users")
     for discord_id, rating in ccursor.fetchall():
-        member = guild.get_member(discord_id)
-        if member:
-            await update_user_role_cc(member, rating)
+        for guild in bot.guilds:
+            member = guild.get_member(discord_id)
+            if member:
+                await update_user_role_cc(member, rating)
 # crazy marker
 
 class CCStatsView(View):
@@ -412,6 +481,52 @@ def check_compilation_error(handle):
                 return True
     return False
 
+def get_codeforces_ranks(handles):
+    """Fetches current ranks for many handles, batching them into as few user.info calls as possible.
+
+    Blocks for CF_CALL_DELAY between calls to respect the API limit, so run it with asyncio.to_thread.
+    """
+    ranks = {}
+    first_call = True
+    for i in range(0, len(handles), CF_BATCH_SIZE):
+        batch = handles[i:i + CF_BATCH_SIZE]
+        for _ in range(CF_MAX_ATTEMPTS):
+            if not first_call:
+                time.sleep(CF_CALL_DELAY)
+            first_call = False
+
+            url = f"https://codeforces.com/api/user.info?handles={';'.join(batch)}"
+            try:
+                response = requests.get(url).json()
+            except (requests.RequestException, ValueError) as e:
+                logger.error(f"Batch rank fetch failed: {e}")
+                break
+
+            if "result" in response:
+                # Results come back in request order; renamed accounts are returned under their new handle
+                for handle, user_info in zip(batch, response["result"]):
+                    ranks[handle] = user_info.get("rank", "Newbie")
+                break
+
+            comment = response.get("comment", "")
+            if "Call limit exceeded" in comment:
+                logger.warning("Codeforces call limit exceeded, retrying batch.")
+                continue
+
+            # Each unknown handle fails the whole batch, so drop it and retry until the batch succeeds
+            match = re.search(r"User with handle (\S+) not found", comment)
+            missing = match.group(1).lower() if match else None
+            if not missing or missing not in (handle.lower() for handle in batch):
+                logger.warning(f"Batch rank fetch failed: {comment}")
+                break
+            logger.warning(f"Codeforces handle {match.group(1)} not found, skipping it this cycle.")
+            batch = [handle for handle in batch if handle.lower() != missing]
+            if not batch:
+                break
+        else:
+            logger.warning(f"Gave up on a batch of {len(batch)} handles after {CF_MAX_ATTEMPTS} attempts.")
+    return ranks
+
 def get_codeforces_rank(handle):
     url = f"https://codeforces.com/api/user.info?handles={handle}"
     response = requests.get(url).json()
@@ -472,7 +587,7 @@ def get_solved_streak(handle):
 async def on_message(message):
     """Deletes messages in the verification channel after 5 seconds."""
     await bot.process_commands(message)
-    if message.channel.id == VERIFY_CHANNEL_ID and not message.author.bot:
+    if is_verify_channel(message.channel) and not message.author.bot:
         await asyncio.sleep(5)
         try:
             await message.delete()
@@ -484,7 +599,7 @@ async def on_message(message):
 @bot.command()
 async def verifycf(ctx, handle: str = None):
     """Verify your Codeforces account."""
-    if ctx.channel.id != VERIFY_CHANNEL_ID:
+    if not is_verify_channel(ctx.channel):
         return
 
     if not handle:
@@ -502,7 +617,7 @@ async def verifycf(ctx, handle: str = None):
         if check_compilation_error(handle):
             if verify_user(user.id, handle):
                 rank = get_codeforces_rank(handle)
-                role_name = ROLE_MAP.get(rank.lower(), "Newbie")
+                role_name = get_guild_config(ctx.guild.id)["role_map"].get(rank.lower(), "Newbie")
                 role = discord.utils.get(ctx.guild.roles, name=role_name)
 
                 if role:
@@ -621,36 +736,220 @@ async def cfstats(ctx, member: discord.Member = None):
     view.message = await ctx.send(embed=view.create_embed(), view=view)
 
 
+@bot.command()
+@commands.guild_only()
+@commands.has_permissions(manage_guild=True)
+async def setverifychannel(ctx, channel: discord.TextChannel = None):
+    """Sets the channel where verification commands are accepted in this server."""
+    channel = channel or ctx.channel
+    set_guild_config(ctx.guild.id, verify_channel_id=channel.id)
+    await ctx.send(f"✅ Verification channel set to {channel.mention}.")
+    logger.info(f"Guild {ctx.guild.id} verification channel set to {channel.id}.")
+
+@bot.command()
+@commands.guild_only()
+@commands.has_permissions(manage_guild=True)
+async def setannouncechannel(ctx, channel: discord.TextChannel = None):
+    """Sets the announcement channel for this server."""
+    channel = channel or ctx.channel
+    set_guild_config(ctx.guild.id, announcement_channel_id=channel.id)
+    await ctx.send(f"✅ Announcement channel set to {channel.mention}.")
+    logger.info(f"Guild {ctx.guild.id} announcement channel set to {channel.id}.")
+
+@bot.command()
+@commands.guild_only()
+@commands.has_permissions(manage_guild=True)
+async def setrole(ctx, role: discord.Role, *, rank: str):
+    """Maps a Codeforces rank to a role in this server. Usage: `!setrole @Role candidate master`"""
+    rank = rank.lower()
+    if rank not in ROLE_MAP:
+        await ctx.send(f"❌ Unknown rank `{rank}`. Valid ranks: {', '.join(ROLE_MAP)}")
+        return
+
+    role_map = dict(get_guild_config(ctx.guild.id)["role_map"])
+    role_map[rank] = role.name
+    set_guild_config(ctx.guild.id, role_map=json.dumps(role_map))
+    await ctx.send(f"✅ `{rank}` now maps to the `{role.name}` role.")
+    logger.info(f"Guild {ctx.guild.id} mapped rank {rank} to role {role.name}.")
+
+
 @tasks.loop(hours=6)
 async def update_roles():
     await bot.wait_until_ready()
-    guild = bot.get_guild(GUILD_ID)
-    if guild is None:
-        logger.warning("Guild not found.")
-        return
-    
     cursor.execute("SELECT user_id, handle, rank FROM verified_users WHERE verified = 1")
     users = cursor.fetchall()
-    
+    if not users:
+        return
+
+    # Refresh every handle once, then fan the result out to every guild the user is in
+    ranks = await asyncio.to_thread(get_codeforces_ranks, [handle for _, handle, _ in users])
+
     for user_id, handle, old_rank in users:
-        stats = get_codeforces_stats(handle)
-        if stats and stats["rank"] != old_rank:
+        new_rank = ranks.get(handle)
+        if not new_rank:
+            continue
+
+        # Apply in every guild so members who joined later or newly configured role maps catch up
+        for guild in bot.guilds:
             member = guild.get_member(user_id)
-            if member:
-                new_role_name = ROLE_MAP.get(stats["rank"].lower())
-                if new_role_name:
-                    new_role = discord.utils.get(guild.roles, name=new_role_name)
-                    if new_role:
-                        await member.add_roles(new_role)
-                        logger.info(f"Updated role for {member.name} to {new_role_name}")
-                        cursor.execute("UPDATE verified_users SET rank = ? WHERE user_id = ?", (stats["rank"], user_id))
-                        db.commit()
+            if not member:
+                continue
+            new_role_name = get_guild_config(guild.id)["role_map"].get(new_rank.lower())
+            new_role = discord.utils.get(guild.roles, name=new_role_name) if new_role_name else None
+            if new_role and new_role not in member.roles:
+                await member.add_roles(new_role)
+                logger.info(f"Updated role for {member.name} in guild {guild.id} to {new_role_name}")
+
+        if new_rank != old_rank:
+            cursor.execute("UPDATE verified_users SET rank = ? WHERE user_id = ?", (new_rank, user_id))
+            db.commit()
+
+class LoopWatchdog:
+    """Measures event-loop lag and samples the stack of anything that blocks the loop.
+
+    A coroutine ticks every quarter threshold. The gap between ticks minus one tick is a
+    lower bound on how long the loop was blocked; above the threshold it counts as a slow
+    callback. A daemon thread polls ten times per tick and grabs the loop thread's stack
+    once when ticks stop for longer than the threshold, so the blocking command shows up
+    in the report.
+    """
+
+    def __init__(self, threshold_ms, report_minutes):
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 4
+        self.poll_interval = self.interval / 10
+        self.report_seconds = report_minutes * 60
+        self.lock = threading.Lock()
+        self.loop_thread_id = None
+        self.last_tick = time.monotonic()
+        self.pending_stall = None
+        self.stalls = deque(maxlen=50)
+        self.command_codes = {}
+        self.task = None
+        self.report_logger = logging.getLogger("loop_health")
+        self.report_logger.setLevel(logging.INFO)
+        self.report_logger.propagate = False
+        self.report_logger.addHandler(logging.FileHandler(os.path.join(LOG_DIR, "loop_health.log")))
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_start = time.monotonic()
+        self.ticks = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_count = 0
+        self.unsampled_count = 0
+
+    def start(self):
+        if self.task is not None:
+            return
+        self.command_codes = {command.callback.__code__: command.name for command in bot.walk_commands()}
+        for view_class in View.__subclasses__():
+            for name, attr in vars(view_class).items():
+                if hasattr(attr, "__discord_ui_model_type__"):
+                    self.command_codes[attr.__code__] = f"{view_class.__name__}.{name}"
+        for name, value in globals().items():
+            if isinstance(value, tasks.Loop):
+                self.command_codes[value.coro.__code__] = name
+        self.task = asyncio.get_running_loop().create_task(self.monitor())
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        logger.info(f"Loop watchdog started (threshold {self.threshold * 1000:.0f} ms).")
+
+    async def monitor(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - before - self.interval
+            with self.lock:
+                # The gap since the previous tick covers the whole blocking callback, unlike the lag;
+                # up to one interval of it may have been idle sleep
+                blocked = now - self.last_tick - self.interval
+                self.last_tick = now
+                self.ticks += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+                if blocked > self.threshold:
+                    stall = self.pending_stall or {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "command": "unknown", "stack": []}
+                    stall["blocked_ms"] = blocked * 1000
+                    self.stalls.append(stall)
+                    self.slow_count += 1
+                    if self.pending_stall is None:
+                        self.unsampled_count += 1
+                    logger.warning(f"Event loop blocked for ~{blocked * 1000:.0f} ms in {stall['command']}.")
+                self.pending_stall = None
+            if now - self.window_start >= self.report_seconds:
+                self.write_report()
+
+    def watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                stalled = time.monotonic() - self.last_tick > self.threshold
+                if not stalled or self.pending_stall is not None or self.loop_thread_id is None:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.pending_stall = {
+                        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                        "command": self.find_command(frame),
+                        "stack": self.sample_stack(frame)
+                    }
+
+    def sample_stack(self, frame):
+        """Formats the frames from this file plus the innermost few, so library-deep stalls still show the command step."""
+        entries = traceback.extract_stack(frame)
+        innermost = len(entries) - 5
+        kept = [entry for i, entry in enumerate(entries) if entry.filename == __file__ or i >= innermost]
+        return traceback.format_list(kept)
+
+    def find_command(self, frame):
+        """Returns the command, view callback or task on the stack, or the innermost function from this file."""
+        innermost = None
+        while frame is not None:
+            if frame.f_code in self.command_codes:
+                return self.command_codes[frame.f_code]
+            if innermost is None and frame.f_code.co_filename == __file__ and frame.f_code.co_name != "<module>":
+                innermost = frame.f_code.co_name
+            frame = frame.f_back
+        return innermost or "unknown"
+
+    def write_report(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.window_start
+            avg_lag = self.total_lag / self.ticks if self.ticks else 0.0
+            stalls = list(self.stalls)
+            lines = [
+                f"=== Loop health report {time.strftime('%Y-%m-%d %H:%M:%S')} ({elapsed / 60:.1f} min) ===",
+                f"Average lag: {avg_lag * 1000:.1f} ms, max lag: {self.max_lag * 1000:.1f} ms, "
+                f"slow callbacks (> {self.threshold * 1000:.0f} ms): {self.slow_count}"
+            ]
+            if self.unsampled_count:
+                lines.append(f"{self.unsampled_count} slow callbacks ended before a stack sample was taken.")
+            if self.slow_count > len(stalls):
+                lines.append(f"Showing the last {len(stalls)} stalls.")
+            self.stalls.clear()
+            self.reset_window()
+
+        for stall in stalls:
+            lines.append(f"[{stall['time']}] blocked ~{stall['blocked_ms']:.0f} ms in {stall['command']}")
+            lines.extend(line.rstrip() for line in stall["stack"])
+        self.report_logger.info("\n".join(lines))
+
+
+watchdog = LoopWatchdog(SLOW_CALLBACK_MS, DIAGNOSTICS_REPORT_MINUTES) if DIAGNOSTICS else None
 
 @bot.event
 async def on_ready():
-    logger.info(f'Logged in as {bot.user}')
+    logger.info(f'Logged in as {bot.user} ({len(bot.guilds)} guilds, {bot.shard_count or 1} shards)')
     cursor.execute("DELETE FROM verified_users WHERE verified = 0")
     db.commit()
-    update_roles.start()
+    # on_ready fires again after reconnects, so only start the loop once
+    if not update_roles.is_running():
+        update_roles.start()
+    if watchdog:
+        watchdog.start()
 
 bot.run(TOKEN)